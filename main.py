@@ -1,11 +1,22 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import pydeck as pdk
-import json
+import streamlit.components.v1 as components
+import orjson
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
-import os
-from typing import List, Dict, Tuple
+import pathlib
+import tempfile
+import shutil
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Tuple
 
 # Set page config
 st.set_page_config(page_title="Tree Construction Protection Zones", layout="wide")
@@ -22,74 +33,290 @@ def calculate_protection_radius(diameter):
     """
     Calculate protection zone radius in feet based on tree diameter.
     Formula: 5 feet minimum + 1 foot for every inch over 5 inches
+    Accepts a scalar or a NumPy array of diameters.
     """
-    if diameter <= 5:
-        return 5.0
-    else:
-        return 5.0 + (diameter - 5.0)
+    return np.maximum(np.float32(5.0), diameter)
 
 # Function to convert feet to meters (pydeck uses meters by default)
 def feet_to_meters(feet):
-    return feet * 0.3048
+    return feet * np.float32(0.3048)
+
+# Output columns mapped to (primary property, fallback property, default)
+PROPERTY_ALIASES = {
+    'diameter': ('DIAMETER', 'diameter', 0),
+    'species_common': ('SPP_COM', 'species_common', 'Unknown'),
+    'species_botanical': ('SPP_BOT', 'species_botanical', 'Unknown'),
+    'status': ('STATUS', 'status', 'Unknown'),
+    'site_id': ('site_id', 'OBJECTID', 'Unknown'),
+    'object_id': ('OBJECTID', 'object_id', None),
+}
 
 # Function to process GeoJSON data
 def process_geojson_data(geojson_data):
     """Extract features from GeoJSON and create DataFrame."""
-    features = []
-    for feature in geojson_data['features']:
-        props = feature['properties']
-        coords = feature['geometry']['coordinates']
-        
-        # Extract relevant fields with fallbacks
-        features.append({
-            'longitude': coords[0],
-            'latitude': coords[1],
-            'diameter': props.get('DIAMETER', props.get('diameter', 0)),
-            'species_common': props.get('SPP_COM', props.get('species_common', 'Unknown')),
-            'species_botanical': props.get('SPP_BOT', props.get('species_botanical', 'Unknown')),
-            'status': props.get('STATUS', props.get('status', 'Unknown')),
-            'site_id': props.get('site_id', props.get('OBJECTID', 'Unknown')),
-            'object_id': props.get('OBJECTID', props.get('object_id', None))
-        })
+    features = geojson_data['features']
+    props = [feature['properties'] for feature in features]
+    coords = [feature['geometry']['coordinates'] for feature in features]
+    
+    # Build each column in one pass instead of a dict per row
+    columns = {
+        'longitude': [c[0] for c in coords],
+        'latitude': [c[1] for c in coords],
+    }
+    for column, (primary, fallback, default) in PROPERTY_ALIASES.items():
+        columns[column] = [p.get(primary, p.get(fallback, default)) for p in props]
+    
+    return pd.DataFrame(columns) if features else pd.DataFrame()
+
+# Columns shown in the map tooltip, sent with every pickable layer
+TOOLTIP_COLUMNS = ['species_common', 'species_botanical', 'diameter',
+                   'protection_radius_feet', 'status', 'site_id']
+
+# Everything the map and statistics read from the filtered trees
+MAP_COLUMNS = ['longitude', 'latitude', 'protection_radius_meters', *TOOLTIP_COLUMNS]
+
+def set_dataset_attrs(df: pd.DataFrame, dataset_key) -> pd.DataFrame:
+    """Attach the dataset key and map center that downstream code reads from df.attrs."""
+    # Cheap identity for downstream caches, so they never hash the frame itself
+    df.attrs['dataset_key'] = dataset_key
+    if not df.empty:
+        # Map center of the whole dataset, reused for every filter
+        df.attrs['center'] = (float(df['latitude'].mean()), float(df['longitude'].mean()))
+    return df
+
+# Bump whenever prepare_tree_df changes its columns or dtypes, so saved frames are rebuilt
+TREE_DF_VERSION = 2
+
+def prepare_tree_df(df: pd.DataFrame, dataset_key) -> pd.DataFrame:
+    """Add protection zone radii and narrow dtypes on a freshly extracted DataFrame."""
+    if not df.empty:
+        df['diameter'] = df['diameter'].astype(np.float32)
+        radius_ft = calculate_protection_radius(df['diameter'].to_numpy())
+        df['protection_radius_feet'] = radius_ft
+        # Centimeter precision keeps the JSON shipped to pydeck short
+        df['protection_radius_meters'] = feet_to_meters(radius_ft).astype(np.float64).round(2)
+        # Properties can mix ints with the 'Unknown' defaults, and Parquet
+        # stores one type per column, so mixed columns are kept as text
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].astype(str)
+        for column in ('species_common', 'species_botanical', 'status'):
+            df[column] = df[column].astype('category')
+    return set_dataset_attrs(df, dataset_key)
+
+# Bounded, since callers park the result themselves; the cache only spares
+# uploads from being parsed again on every rerun
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_tree_df(geojson_bytes: bytes) -> pd.DataFrame:
+    """Parse raw GeoJSON bytes into the tree DataFrame with protection zones."""
+    dataset_key = hashlib.md5(geojson_bytes).hexdigest()
+    return prepare_tree_df(process_geojson_data(orjson.loads(geojson_bytes)), dataset_key)
+
+@st.cache_data(show_spinner=False, hash_funcs={pathlib.Path: lambda p: (str(p), p.stat().st_mtime)})
+def read_local_tree_df(path: pathlib.Path) -> pd.DataFrame:
+    """
+    Parse a local GeoJSON file into the tree DataFrame, once per file version.
+    The result is saved to a Parquet sidecar next to the file, which later
+    cold starts read instead of the GeoJSON while it is newer than the file.
+    """
+    geojson_mtime = path.stat().st_mtime
+    dataset_key = (str(path), geojson_mtime)
+    sidecar = path.with_name(f'{path.name}.v{TREE_DF_VERSION}.parquet')
+    
+    if sidecar.exists() and sidecar.stat().st_mtime > geojson_mtime:
+        try:
+            return set_dataset_attrs(pd.read_parquet(sidecar), dataset_key)
+        except (OSError, ValueError, TypeError):
+            # A damaged sidecar is rebuilt from the GeoJSON below
+            sidecar.unlink(missing_ok=True)
     
-    return pd.DataFrame(features)
+    with open(path, 'rb') as f:
+        df = prepare_tree_df(process_geojson_data(orjson.loads(f.read())), dataset_key)
+    
+    # The sidecar is only a speedup, so an unwritable directory or a frame
+    # pyarrow cannot store (ArrowInvalid/ArrowTypeError) is not an error.
+    # Write then rename so an interrupted write never leaves a partial sidecar
+    tmp_path = sidecar.with_suffix(f'.{threading.get_ident()}.tmp')
+    try:
+        df.to_parquet(tmp_path, compression='zstd')
+        tmp_path.replace(sidecar)
+    except (OSError, ImportError, ValueError, TypeError):
+        tmp_path.unlink(missing_ok=True)
+    return df
+
+def filter_by_diameter(df: pd.DataFrame, min_diameter: float) -> pd.DataFrame:
+    """Return the map columns of the trees at or above the minimum diameter."""
+    # Compare in float32 so the diameter array is never upcast, then select
+    # rows and columns by position in one take, with no index alignment
+    rows = np.flatnonzero(df['diameter'].to_numpy() >= np.float32(min_diameter))
+    return df.iloc[rows, df.columns.get_indexer(MAP_COLUMNS)]
 
 # Function to load local GeoJSON file
 def load_local_geojson(filename="Urban_Forestry_Street_Trees.geojson"):
-    """Attempt to load a local GeoJSON file."""
+    """Attempt to load a local GeoJSON file as the tree DataFrame."""
     try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                return json.load(f)
+        path = pathlib.Path(filename)
+        if path.exists():
+            return read_local_tree_df(path)
         return None
     except Exception as e:
         st.error(f"Error reading local file {filename}: {str(e)}")
         return None
 
+# Processed tree frames kept on disk at once, across all sessions
+TREE_DF_MAX_FILES = 8
+
+# Prefix of the temporary directory holding processed tree frames
+TREE_DF_DIR_PREFIX = 'tree_protection_zones_'
+
+# Processed frames are parked on disk between reruns instead of in session state
+class TreeFrameStore:
+    """Processed tree frames parked as Parquet, evicting the least recently used."""
+    
+    def __init__(self, max_files: int = TREE_DF_MAX_FILES):
+        self.max_files = max_files
+        self._paths = OrderedDict()
+        self._lock = threading.Lock()
+        
+        # Directories left by earlier server runs are never read again
+        for stale in pathlib.Path(tempfile.gettempdir()).glob(f'{TREE_DF_DIR_PREFIX}*'):
+            shutil.rmtree(stale, ignore_errors=True)
+        self.directory = pathlib.Path(tempfile.mkdtemp(prefix=TREE_DF_DIR_PREFIX))
+    
+    def store(self, df: pd.DataFrame) -> pathlib.Path:
+        """Write df to Parquet once per dataset and return its path."""
+        # One file per dataset, so sessions viewing the same data share it
+        digest = hashlib.md5(repr(df.attrs.get('dataset_key')).encode()).hexdigest()
+        path = self.directory / f'trees_{digest}.parquet'
+        
+        with self._lock:
+            if digest in self._paths:
+                self._paths.move_to_end(digest)
+                return path
+        
+        # Write then rename so other sessions never read a partial file
+        tmp_path = path.with_suffix(f'.{threading.get_ident()}.tmp')
+        try:
+            df.to_parquet(tmp_path, compression='zstd', compression_level=3)
+            tmp_path.replace(path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        
+        with self._lock:
+            self._paths[digest] = path
+            self._paths.move_to_end(digest)
+            while len(self._paths) > self.max_files:
+                _, evicted = self._paths.popitem(last=False)
+                evicted.unlink(missing_ok=True)
+        return path
+    
+    def load(self, path: pathlib.Path):
+        """Read a parked frame back, or return None once it has been evicted."""
+        with self._lock:
+            digest = path.stem.removeprefix('trees_')
+            if digest not in self._paths:
+                return None
+            self._paths.move_to_end(digest)
+        try:
+            return pd.read_parquet(path)
+        except FileNotFoundError:
+            return None
+
+# Shared so every session parks into, and evicts from, the same set of files
+@st.cache_resource
+def get_tree_frame_store() -> TreeFrameStore:
+    """Return the store of processed tree frames for this server."""
+    return TreeFrameStore()
+
+def store_tree_df(df: pd.DataFrame) -> None:
+    """Persist the tree DataFrame as Parquet and point this session at it."""
+    try:
+        path = get_tree_frame_store().store(df)
+    except (OSError, ImportError, ValueError, TypeError):
+        # Parking on disk is only a memory saving; keep the frame itself instead
+        st.session_state.pop('tree_df_path', None)
+        st.session_state['tree_df'] = df
+        return
+    st.session_state.pop('tree_df', None)
+    st.session_state['tree_df_path'] = path
+
+def has_session_tree_df() -> bool:
+    """Return whether this session has loaded a tree DataFrame."""
+    return 'tree_df_path' in st.session_state or 'tree_df' in st.session_state
+
+def load_session_tree_df():
+    """Read this session's tree DataFrame back from disk, if one was loaded."""
+    path = st.session_state.get('tree_df_path')
+    if path is None:
+        return st.session_state.get('tree_df')
+    
+    df = get_tree_frame_store().load(path)
+    if df is None:
+        # Evicted to make room for newer datasets; look for the local file again next run
+        del st.session_state['tree_df_path']
+        st.session_state.pop('checked_local_file', None)
+        st.warning("The loaded dataset has expired. Please load it again.")
+    return df
+
 # Try to load local file first
-geojson_data = None
+tree_df = None
 local_file_loaded = False
 
 # Check for local file on app start
 if 'checked_local_file' not in st.session_state:
     st.session_state['checked_local_file'] = True
-    local_data = load_local_geojson()
-    if local_data:
-        st.session_state['geojson_data'] = local_data
+    local_df = load_local_geojson()
+    if local_df is not None:
+        store_tree_df(local_df)
         local_file_loaded = True
         st.success("✅ Automatically loaded local file: Urban_Forestry_Street_Trees.geojson")
 
 # Use cached local data if available
-if 'geojson_data' in st.session_state and not local_file_loaded:
-    geojson_data = st.session_state['geojson_data']
-    local_file_loaded = True
+if has_session_tree_df() and not local_file_loaded:
+    tree_df = load_session_tree_df()
+    local_file_loaded = tree_df is not None
 
 # Default URLs for Madison tree data
 MADISON_TREES_BASE_URL = "https://maps.cityofmadison.com/arcgis/rest/services/Public/OPEN_DATA/MapServer/0/query"
 
-# Default batch sizes
-OBJECT_ID_BATCH_SIZE = 1000
-FEATURE_BATCH_SIZE = 100
+# Only the Madison tree fields the app reads (see PROPERTY_ALIASES)
+MADISON_TREES_OUT_FIELDS = "OBJECTID,DIAMETER,SPP_COM,SPP_BOT,STATUS,site_id"
+
+# Step of the minimum diameter slider, in inches
+DIAMETER_STEP = 0.5
+
+# Default page size
+FEATURE_PAGE_SIZE = 2000
+
+# Maximum number of feature pages requested at the same time
+FEATURE_FETCH_CONCURRENCY = 8
+
+# Statuses the server uses to ask clients to slow down, and how long
+# (in seconds) after one is seen that new requests should pause
+BACKPRESSURE_STATUSES = (429, 503)
+BACKPRESSURE_WINDOW = 10
+
+class BackpressureRetry(Retry):
+    """Retry policy that reports the delay a throttled response asked for."""
+    
+    def __init__(self, *args, on_backpressure=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_backpressure = on_backpressure
+    
+    def new(self, **kw):
+        # Retry.new only copies its own settings, so carry the callback along
+        retry = super().new(**kw)
+        retry.on_backpressure = self.on_backpressure
+        return retry
+    
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        # Only here is the throttled response (and its Retry-After) visible;
+        # report it before super() raises too, so exhausted retries count
+        if response is not None and response.status in BACKPRESSURE_STATUSES and self.on_backpressure:
+            retry_after = self.get_retry_after(response)
+            self.on_backpressure(retry_after if retry_after is not None
+                                 else max(self.backoff_factor, self.get_backoff_time()))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
 
 class ArcGISPaginatedClient:
     """Client for handling paginated requests to ArcGIS REST services."""
@@ -98,109 +325,130 @@ class ArcGISPaginatedClient:
         self.base_url = base_url
         self.timeout = timeout
         
-    def get_object_ids(self, where_clause: str = "1=1", batch_size: int = 1000) -> List[int]:
-        """Get all object IDs using pagination."""
-        all_object_ids = []
-        offset = 0
-        batch_count = 0
-        
-        progress_placeholder = st.empty()
+        # Reuse pooled connections so each batch skips the TCP/TLS handshake
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=BackpressureRetry(
+                total=5,
+                backoff_factor=1.0,
+                status_forcelist=[429, 500, 502, 503, 504],
+                respect_retry_after_header=True,
+                on_backpressure=self._note_backpressure
+            )
+        )
+        self.session.mount('https://', adapter)
         
-        while True:
-            progress_placeholder.text(f"Fetching object IDs: {len(all_object_ids)} retrieved...")
-            
-            params = {
-                'where': where_clause,
-                'returnIdsOnly': 'true',
-                'f': 'json',
-                'resultOffset': offset,
-                'resultRecordCount': batch_size
-            }
-            
-            try:
-                response = requests.get(self.base_url, params=params, timeout=self.timeout)
-                response.raise_for_status()
-                data = response.json()
-                
-                if 'objectIds' in data and data['objectIds']:
-                    batch_ids = data['objectIds']
-                    all_object_ids.extend(batch_ids)
-                    
-                    # If we got fewer records than requested, we've reached the end
-                    if len(batch_ids) < batch_size:
-                        break
-                        
-                    offset += len(batch_ids)
-                    batch_count += 1
-
-                    # Sleep for 5 seconds every 10 batches
-                    if batch_count % 10 == 0:
-                        time.sleep(5)
-                    else:
-                        time.sleep(1)  # Regular delay between batches
-                else:
-                    break
-                    
-            except requests.exceptions.RequestException as e:
-                st.error(f"Error fetching object IDs at offset {offset}: {str(e)}")
-                break
-            except Exception as e:
-                st.error(f"Error processing object IDs response: {str(e)}")
-                break
+        # Set when the server last signaled backpressure
+        self._last_429_at = None
+        self._retry_after = 0.0
     
-        progress_placeholder.text(f"✅ Retrieved {len(all_object_ids)} object IDs total")
-        return all_object_ids
+    def _note_backpressure(self, delay: float) -> None:
+        """Remember a throttled response so other batches back off too."""
+        self._retry_after = delay
+        self._last_429_at = time.monotonic()
     
-    def get_features_by_ids(self, object_ids: List[int], out_fields: str = "*") -> Dict:
-        """Get features by object IDs in batches."""
-        all_features = []
+    def _get(self, params: Dict) -> requests.Response:
+        """Send a query, pausing only if the server recently asked us to slow down."""
+        if self._last_429_at is not None and time.monotonic() - self._last_429_at < BACKPRESSURE_WINDOW:
+            time.sleep(self._retry_after)
+        
+        # Throttled attempts are retried, and recorded, by BackpressureRetry
+        return self.session.get(self.base_url, params=params, timeout=self.timeout)
+        
+    def get_feature_count(self, where_clause: str = "1=1") -> int:
+        """Get the number of features matching the where clause."""
+        params = {
+            'where': where_clause,
+            'returnCountOnly': 'true',
+            'f': 'json'
+        }
         
-        # Process object IDs in chunks
-        id_chunks = [object_ids[i:i + FEATURE_BATCH_SIZE] 
-                    for i in range(0, len(object_ids), FEATURE_BATCH_SIZE)]
+        response = self._get(params)
+        response.raise_for_status()
+        return orjson.loads(response.content).get('count', 0)
+    
+    def _fetch_feature_page(self, offset: int, page_size: int, where_clause: str, out_fields: str) -> Dict:
+        """Fetch a single page of features starting at offset."""
+        params = {
+            'where': where_clause,
+            'outFields': out_fields,
+            'returnGeometry': 'true',
+            'orderByFields': 'OBJECTID',
+            'f': 'geojson',
+            'resultOffset': offset,
+            'resultRecordCount': page_size
+        }
         
-        progress_bar = st.progress(0)
+        response = self._get(params)
+        response.raise_for_status()
+        return orjson.loads(response.content)
+    
+    def fetch_all_features_direct(self, where_clause: str = "1=1", out_fields: str = "*",
+                                  page_size: int = FEATURE_PAGE_SIZE) -> Dict:
+        """Get all features by paginating the feature query, with pages fetched concurrently."""
         status_text = st.empty()
+        status_text.text("Fetching features: 0 retrieved...")
         
-        for i, chunk in enumerate(id_chunks):
-            status_text.text(f"Processing batch {i+1}/{len(id_chunks)} ({len(chunk)} features)...")
-            
-            # Convert IDs to comma-separated string
-            object_ids_str = ','.join(map(str, chunk))
+        try:
+            total = self.get_feature_count(where_clause)
+            first_page = self._fetch_feature_page(0, page_size, where_clause, out_fields)
+        except requests.exceptions.RequestException as e:
+            st.error(f"Error fetching features at offset 0: {str(e)}")
+            return {'type': 'FeatureCollection', 'features': []}
+        except Exception as e:
+            st.error(f"Error processing features response: {str(e)}")
+            return {'type': 'FeatureCollection', 'features': []}
+        
+        pages = [first_page.get('features', [])]
+        
+        # GeoJSON responses report the limit under 'properties'
+        exceeded = first_page.get('exceededTransferLimit',
+                                  first_page.get('properties', {}).get('exceededTransferLimit', False))
+        
+        # The server may cap pages below page_size, so step by what it sent
+        step = len(pages[0])
+        if step and exceeded:
+            offsets = list(range(step, total, step))
+            pages.extend([] for _ in offsets)
+            progress_bar = st.progress(0)
             
-            params = {
-                'objectIds': object_ids_str,
-                'outFields': out_fields,
-                'returnGeometry': 'true',
-                'f': 'geojson'
-            }
+            # Overlap requests on the pooled session; Streamlit calls stay on this thread
+            with ThreadPoolExecutor(max_workers=FEATURE_FETCH_CONCURRENCY) as executor:
+                futures = {
+                    executor.submit(self._fetch_feature_page, offset, step, where_clause, out_fields): i
+                    for i, offset in enumerate(offsets, start=1)
+                }
+                for completed, future in enumerate(as_completed(futures), start=1):
+                    i = futures[future]
+                    status_text.text(f"Fetched page {completed}/{len(offsets)} (offset {offsets[i - 1]})...")
+                    
+                    try:
+                        pages[i] = future.result().get('features', [])
+                    except requests.exceptions.RequestException as e:
+                        st.error(f"Error fetching features at offset {offsets[i - 1]}: {str(e)}")
+                    except Exception as e:
+                        st.error(f"Error processing features response: {str(e)}")
+                    
+                    # Update progress
+                    progress_bar.progress(completed / len(offsets))
             
-            try:
-                response = requests.get(self.base_url, params=params, timeout=self.timeout)
-                response.raise_for_status()
-                chunk_data = response.json()
-                
-                if 'features' in chunk_data:
-                    all_features.extend(chunk_data['features'])
-                
-                # Update progress
-                progress_bar.progress((i + 1) / len(id_chunks))
-                
-                # Sleep for 5 seconds every 10 batches
-                if (i + 1) % 10 == 0:
-                    time.sleep(5)
-                else:
-                    time.sleep(1)  # Regular delay between batches
-                
-            except requests.exceptions.RequestException as e:
-                st.error(f"Error fetching features for batch {i+1}: {str(e)}")
-                continue
-            except Exception as e:
-                st.error(f"Error processing features response for batch {i+1}: {str(e)}")
-                continue
+            progress_bar.empty()
+        
+        # Keep pages in offset order; a server without pagination support
+        # ignores resultOffset and sends the same page again, so stop there
+        all_features = []
+        seen_ids = set()
+        for features in pages:
+            page_ids = {feature.get('id', feature['properties'].get('OBJECTID')) for feature in features}
+            if page_ids and page_ids <= seen_ids:
+                st.warning(f"Server ignored resultOffset; stopped at {len(all_features)} of {total} features.")
+                break
+            seen_ids |= page_ids
+            all_features.extend(features)
         
         status_text.text(f"✅ Successfully processed {len(all_features)} features")
-        progress_bar.empty()
         
         # Return in GeoJSON format
         return {
@@ -208,6 +456,12 @@ class ArcGISPaginatedClient:
             'features': all_features
         }
 
+# Shared client so its connection pool survives reruns and button clicks
+@st.cache_resource
+def get_arcgis_client(base_url: str) -> ArcGISPaginatedClient:
+    """Return the long-lived paginated client for an ArcGIS service."""
+    return ArcGISPaginatedClient(base_url)
+
 # Function to fetch GeoJSON from URL (legacy method for simple requests)
 @st.cache_data
 def get_geojson_from_url(url):
@@ -215,25 +469,181 @@ def get_geojson_from_url(url):
     try:
         response = requests.get(url, timeout=30)
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
     except requests.exceptions.RequestException as e:
         st.error(f"Error fetching data from URL: {str(e)}")
         return None
 
+# Streamlit serves this folder at app/static/ (server.enableStaticServing)
+STATIC_DIR = pathlib.Path(__file__).parent / 'static'
+
+# Bump whenever the columns or rounding of the published tree files change
+STATIC_FORMAT_VERSION = 1
+
+# Filtered tree files kept in STATIC_DIR at once, across all sessions
+STATIC_MAX_FILES = 8
+
+class StaticTreeFiles:
+    """Filtered tree files published under STATIC_DIR, evicting the least recently used."""
+    
+    def __init__(self, max_files: int = STATIC_MAX_FILES):
+        self.max_files = max_files
+        # Files are served without authentication and the folder is not
+        # listable, so a secret in each name keeps uploads unguessable
+        self._salt = secrets.token_hex(16)
+        self._paths = OrderedDict()
+        self._lock = threading.Lock()
+        
+        # Files left by earlier server runs may hold an older format
+        STATIC_DIR.mkdir(exist_ok=True)
+        for stale in STATIC_DIR.glob('trees_*'):
+            stale.unlink(missing_ok=True)
+    
+    def publish(self, key, df: pd.DataFrame) -> str:
+        """Write df to a static JSON file once per key and return its URL."""
+        digest = hashlib.sha256(repr((STATIC_FORMAT_VERSION, self._salt, key)).encode()).hexdigest()
+        path = STATIC_DIR / f'trees_{digest}.json'
+        
+        with self._lock:
+            if digest in self._paths:
+                self._paths.move_to_end(digest)
+                return f'app/static/{path.name}'
+        
+        # Write then rename so other sessions never read a partial file
+        tmp_path = path.with_suffix(f'.{threading.get_ident()}.tmp')
+        df.to_json(tmp_path, orient='records')
+        tmp_path.replace(path)
+        
+        with self._lock:
+            self._paths[digest] = path
+            self._paths.move_to_end(digest)
+            while len(self._paths) > self.max_files:
+                _, evicted = self._paths.popitem(last=False)
+                evicted.unlink(missing_ok=True)
+        return f'app/static/{path.name}'
+
+# Shared so every session publishes into, and evicts from, the same set of files
+@st.cache_resource
+def get_static_tree_files() -> StaticTreeFiles:
+    """Return the registry of published tree files for this server."""
+    return StaticTreeFiles()
+
+# Function to publish filtered trees as a static file the browser loads itself
+def write_filtered_trees(dataset_key, min_diameter, filtered_df) -> str:
+    """Write the filtered trees to a static JSON file and return its URL."""
+    return get_static_tree_files().publish((dataset_key, min_diameter), filtered_df)
+
+# Hexagon size when trees are aggregated for city-wide viewing
+HEXAGON_RADIUS_METERS = 30
+
+# Function to render the map, cached so unchanged filters skip re-serialization
+@st.cache_data(show_spinner=False)
+def build_deck_html(data_url, center, show_trees, show_zones, zone_opacity, aggregate):
+    """Build the pydeck map for the trees at data_url as standalone HTML."""
+    # Create map layers
+    layers = []
+    
+    # Tree density layer (hexagons), drawn instead of one shape per tree
+    if aggregate:
+        density_layer = pdk.Layer(
+            'HexagonLayer',
+            data=data_url,
+            get_position=['longitude', 'latitude'],
+            radius=HEXAGON_RADIUS_METERS,
+            elevation_scale=0,
+            extruded=False,
+            opacity=zone_opacity,
+            pickable=False
+        )
+        layers.append(density_layer)
+    
+    # Protection zones layer (circles)
+    if show_zones and not aggregate:
+        zone_layer = pdk.Layer(
+            'ScatterplotLayer',
+            data=data_url,
+            get_position=['longitude', 'latitude'],
+            get_radius='protection_radius_meters',
+            get_fill_color=[255, 140, 0, int(zone_opacity * 255)],
+            get_line_color=[255, 100, 0, 200],
+            stroked=True,
+            filled=True,
+            line_width_min_pixels=2,
+            pickable=True,
+            auto_highlight=True
+        )
+        layers.append(zone_layer)
+    
+    # Tree points layer
+    if show_trees and not aggregate:
+        tree_layer = pdk.Layer(
+            'ScatterplotLayer',
+            data=data_url,
+            get_position=['longitude', 'latitude'],
+            get_radius=2,  # Fixed small radius for tree points
+            get_fill_color=[34, 139, 34, 255],  # Forest green
+            get_line_color=[0, 0, 0, 255],
+            stroked=True,
+            filled=True,
+            radius_min_pixels=3,
+            radius_max_pixels=10,
+            line_width_min_pixels=1,
+            pickable=True
+        )
+        layers.append(tree_layer)
+    
+    # Set initial view state (centered on data)
+    center_latitude, center_longitude = center
+    view_state = pdk.ViewState(
+        latitude=center_latitude,
+        longitude=center_longitude,
+        zoom=12,
+        pitch=0
+    )
+    
+    # Create tooltip
+    tooltip = {
+        "html": """
+        <b>Species:</b> {species_common}<br/>
+        <b>Botanical:</b> {species_botanical}<br/>
+        <b>Diameter:</b> {diameter} inches<br/>
+        <b>Protection Zone:</b> {protection_radius_feet} feet<br/>
+        <b>Status:</b> {status}<br/>
+        <b>Site ID:</b> {site_id}
+        """,
+        "style": {
+            "backgroundColor": "steelblue",
+            "color": "white",
+            "padding": "5px",
+            "borderRadius": "5px"
+        }
+    }
+    
+    # Create deck
+    deck = pdk.Deck(
+        map_style='light',
+        initial_view_state=view_state,
+        layers=layers,
+        tooltip=tooltip,
+    )
+    
+    return deck.to_html(as_string=True, notebook_display=False)
+
 # Sidebar for configuration
 st.sidebar.header("Configuration")
 
 # Show data source info and alternative options
 if local_file_loaded:
     st.sidebar.success("🏠 Using local data file")
-    geojson_data = st.session_state['geojson_data']
+    if tree_df is None:
+        tree_df = load_session_tree_df()
     
     # Option to reload or use alternative sources
     st.sidebar.subheader("Alternative Data Sources")
     if st.sidebar.button("🔄 Reload Local File"):
-        local_data = load_local_geojson()
-        if local_data:
-            st.session_state['geojson_data'] = local_data
+        local_df = load_local_geojson()
+        if local_df is not None:
+            store_tree_df(local_df)
             st.sidebar.success("✅ Local file reloaded!")
             st.rerun()
         else:
@@ -251,29 +661,20 @@ if local_file_loaded:
             if st.button("🔄 Load Madison Tree Data", type="primary"):
                 with st.spinner("Loading tree data..."):
                     try:
-                        # Initialize the paginated client
-                        client = ArcGISPaginatedClient(MADISON_TREES_BASE_URL)
+                        # Reuse the cached paginated client
+                        client = get_arcgis_client(MADISON_TREES_BASE_URL)
                         
-                        st.info("Step 1: Fetching all object IDs...")
-                        # Get all object IDs first
-                        object_ids = client.get_object_ids(
-                            batch_size=OBJECT_ID_BATCH_SIZE
-                        )
+                        st.info(f"Fetching features in pages of {FEATURE_PAGE_SIZE}...")
+                        # Page through the features directly, skipping the object ID pass
+                        madison_data = client.fetch_all_features_direct(out_fields=MADISON_TREES_OUT_FIELDS)
                         
-                        if not object_ids:
-                            st.warning("No object IDs found with the given criteria.")
+                        if madison_data['features']:
+                            st.success(f"✅ Successfully loaded {len(madison_data['features'])} features!")
+                            # Cache the result in session state
+                            store_tree_df(build_tree_df(orjson.dumps(madison_data)))
+                            st.rerun()
                         else:
-                            st.info(f"Step 2: Fetching {len(object_ids)} features in batches of {FEATURE_BATCH_SIZE}...")
-                            # Get features using the object IDs
-                            madison_data = client.get_features_by_ids(object_ids)
-                            
-                            if madison_data and 'features' in madison_data:
-                                st.success(f"✅ Successfully loaded {len(madison_data['features'])} features!")
-                                # Cache the result in session state
-                                st.session_state['geojson_data'] = madison_data
-                                st.rerun()
-                            else:
-                                st.error("Failed to fetch feature data.")
+                            st.error("Failed to fetch feature data.")
                                 
                     except Exception as e:
                         st.error(f"Error during paginated fetch: {str(e)}")
@@ -282,8 +683,7 @@ if local_file_loaded:
             uploaded_file = st.file_uploader("Choose a GeoJSON file", type=['geojson', 'json'])
             if uploaded_file is not None:
                 try:
-                    upload_data = json.load(uploaded_file)
-                    st.session_state['geojson_data'] = upload_data
+                    store_tree_df(build_tree_df(uploaded_file.getvalue()))
                     st.success("✅ File uploaded successfully")
                     st.rerun()
                 except Exception as e:
@@ -304,42 +704,34 @@ else:
         if st.sidebar.button("🔄 Load Madison Tree Data", type="primary"):
             with st.spinner("Loading tree data..."):
                 try:
-                    # Initialize the paginated client
-                    client = ArcGISPaginatedClient(MADISON_TREES_BASE_URL)
+                    # Reuse the cached paginated client
+                    client = get_arcgis_client(MADISON_TREES_BASE_URL)
                     
-                    st.info("Step 1: Fetching all object IDs...")
-                    # Get all object IDs first
-                    object_ids = client.get_object_ids(
-                        batch_size=OBJECT_ID_BATCH_SIZE
-                    )
+                    st.info(f"Fetching features in pages of {FEATURE_PAGE_SIZE}...")
+                    # Page through the features directly, skipping the object ID pass
+                    madison_data = client.fetch_all_features_direct(out_fields=MADISON_TREES_OUT_FIELDS)
                     
-                    if not object_ids:
-                        st.warning("No object IDs found with the given criteria.")
+                    if madison_data['features']:
+                        st.success(f"✅ Successfully loaded {len(madison_data['features'])} features!")
+                        # Cache the result in session state
+                        store_tree_df(build_tree_df(orjson.dumps(madison_data)))
                     else:
-                        st.info(f"Step 2: Fetching {len(object_ids)} features in batches of {FEATURE_BATCH_SIZE}...")
-                        # Get features using the object IDs
-                        geojson_data = client.get_features_by_ids(object_ids)
-                        
-                        if geojson_data and 'features' in geojson_data:
-                            st.success(f"✅ Successfully loaded {len(geojson_data['features'])} features!")
-                            # Cache the result in session state
-                            st.session_state['geojson_data'] = geojson_data
-                        else:
-                            st.error("Failed to fetch feature data.")
+                        st.error("Failed to fetch feature data.")
                             
                 except Exception as e:
                     st.error(f"Error during paginated fetch: {str(e)}")
         
         # Use cached data if available
-        if 'geojson_data' in st.session_state:
-            geojson_data = st.session_state['geojson_data']
-            st.sidebar.success(f"✅ Using cached data ({len(geojson_data['features'])} features)")
+        if has_session_tree_df():
+            tree_df = load_session_tree_df()
+        if tree_df is not None:
+            st.sidebar.success(f"✅ Using cached data ({len(tree_df)} features)")
     
     elif data_source == "Upload Custom GeoJSON":
         uploaded_file = st.sidebar.file_uploader("Choose a GeoJSON file", type=['geojson', 'json'])
         if uploaded_file is not None:
             try:
-                geojson_data = json.load(uploaded_file)
+                tree_df = build_tree_df(uploaded_file.getvalue())
                 st.sidebar.success("✅ File uploaded successfully")
             except Exception as e:
                 st.error(f"Error loading file: {str(e)}")
@@ -350,31 +742,34 @@ min_diameter = st.sidebar.slider(
     min_value=0.0,
     max_value=50.0,
     value=0.0,
-    step=0.5,
+    step=DIAMETER_STEP,
     help="Filter trees by minimum diameter"
 )
+# Snap to the slider grid so equal positions share cache entries
+min_diameter = round(min_diameter / DIAMETER_STEP) * DIAMETER_STEP
 
 # Protection zone visualization options
 st.sidebar.subheader("Visualization Options")
 show_trees = st.sidebar.checkbox("Show tree points", value=False)
 show_zones = st.sidebar.checkbox("Show protection zones", value=True)
+aggregate_trees = st.sidebar.checkbox(
+    "Aggregate into hexagons",
+    value=False,
+    help="Draw tree density per hexagon instead of every tree; faster at city-wide zoom"
+)
 zone_opacity = st.sidebar.slider("Zone opacity", 0.0, 1.0, 0.3, 0.05)
 
 # Process and visualize data if available
-if geojson_data is not None:
+if tree_df is not None:
     try:
-        # Create DataFrame from GeoJSON
-        df = process_geojson_data(geojson_data)
+        # Processed once when loaded; reruns read it back from disk
+        df = tree_df
         
         if df.empty:
             st.warning("No data found in the loaded dataset.")
         else:
             # Filter by minimum diameter
-            filtered_df = df[df['diameter'] >= min_diameter].copy()
-            
-            # Calculate protection zone radius for each tree
-            filtered_df['protection_radius_feet'] = filtered_df['diameter'].apply(calculate_protection_radius)
-            filtered_df['protection_radius_meters'] = filtered_df['protection_radius_feet'].apply(feet_to_meters)
+            filtered_df = filter_by_diameter(df, min_diameter)
             
             # Display statistics
             col1, col2, col3, col4 = st.columns(4)
@@ -392,80 +787,15 @@ if geojson_data is not None:
             if len(filtered_df) == 0:
                 st.warning("No trees match the current diameter filter. Try reducing the minimum diameter.")
             else:
-                # Create map layers
-                layers = []
-                
-                # Protection zones layer (circles)
-                if show_zones:
-                    zone_layer = pdk.Layer(
-                        'ScatterplotLayer',
-                        data=filtered_df,
-                        get_position=['longitude', 'latitude'],
-                        get_radius='protection_radius_meters',
-                        get_fill_color=[255, 140, 0, int(zone_opacity * 255)],
-                        get_line_color=[255, 100, 0, 200],
-                        stroked=True,
-                        filled=True,
-                        line_width_min_pixels=2,
-                        pickable=True,
-                        auto_highlight=True
-                    )
-                    layers.append(zone_layer)
-                
-                # Tree points layer
-                if show_trees:
-                    tree_layer = pdk.Layer(
-                        'ScatterplotLayer',
-                        data=filtered_df,
-                        get_position=['longitude', 'latitude'],
-                        get_radius=2,  # Fixed small radius for tree points
-                        get_fill_color=[34, 139, 34, 255],  # Forest green
-                        get_line_color=[0, 0, 0, 255],
-                        stroked=True,
-                        filled=True,
-                        radius_min_pixels=3,
-                        radius_max_pixels=10,
-                        line_width_min_pixels=1,
-                        pickable=True
-                    )
-                    layers.append(tree_layer)
-                
-                # Set initial view state (centered on data)
-                view_state = pdk.ViewState(
-                    latitude=filtered_df['latitude'].mean(),
-                    longitude=filtered_df['longitude'].mean(),
-                    zoom=12,
-                    pitch=0
-                )
-                
-                # Create tooltip
-                tooltip = {
-                    "html": """
-                    <b>Species:</b> {species_common}<br/>
-                    <b>Botanical:</b> {species_botanical}<br/>
-                    <b>Diameter:</b> {diameter} inches<br/>
-                    <b>Protection Zone:</b> {protection_radius_feet} feet<br/>
-                    <b>Status:</b> {status}<br/>
-                    <b>Site ID:</b> {site_id}
-                    """,
-                    "style": {
-                        "backgroundColor": "steelblue",
-                        "color": "white",
-                        "padding": "5px",
-                        "borderRadius": "5px"
-                    }
-                }
-                
-                # Create deck
-                deck = pdk.Deck(
-                    map_style='light',
-                    initial_view_state=view_state,
-                    layers=layers,
-                    tooltip=tooltip,
-                )
-                
-                # Display the map
-                st.pydeck_chart(deck,height=800)
+                # Render the map client-side; the browser fetches the trees by URL
+                data_url = write_filtered_trees(df.attrs['dataset_key'], min_diameter, filtered_df)
+                deck_html = build_deck_html(data_url, df.attrs['center'],
+                                            show_trees, show_zones, zone_opacity, aggregate_trees)
+                # st.iframe supersedes components.html in newer Streamlit releases
+                if hasattr(st, 'iframe'):
+                    st.iframe(deck_html, height=800)
+                else:
+                    components.html(deck_html, height=800)
                 
 
                 
@@ -511,5 +841,6 @@ st.sidebar.markdown("---")
 st.sidebar.subheader("Legend")
 st.sidebar.markdown("🟢 **Green dots**: Tree locations")
 st.sidebar.markdown("🟠 **Orange circles**: Protection zones")
+st.sidebar.markdown("⬢ **Hexagons**: Tree density (when aggregated)")
 st.sidebar.markdown(f"**Current filter**: Trees ≥ {min_diameter} inches")
 